@@ -4,97 +4,409 @@ Cleanup script to keep only MP4 files from extracted dataset
 """
 
 import os
-from pathlib import Path
+import queue
+import shutil
+import subprocess
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+from dataclasses import dataclass
+from functools import lru_cache
+from itertools import islice, repeat
 from tqdm import tqdm
 
+
+# Unlink is blocked in the kernel, not the GIL, so threads overlap well
+DEFAULT_THREADS = min(32, (os.cpu_count() or 4) * 4)
+UNLINK_BATCH_SIZE = 256
+UNLINK_DIR_FD = os.unlink in os.supports_dir_fd
+
+@dataclass
+class ScanStats:
+    """Running totals gathered while scanning for files to remove"""
+    keep_count: int = 0
+    remove_count: int = 0
+    remove_bytes: int = 0
+    
+    def merge(self, other):
+        """Add the totals from another ScanStats into this one"""
+        self.keep_count += other.keep_count
+        self.remove_count += other.remove_count
+        self.remove_bytes += other.remove_bytes
+
+def walk_files(root, recursive=True):
+    """Yield (dirpath, file entries) for root and every directory below it"""
+    subdirs = []
+    files = []
+    with os.scandir(root) as it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.path)
+            elif entry.is_file(follow_symlinks=False):
+                files.append(entry)
+    
+    yield root, files
+    if recursive:
+        for subdir in subdirs:
+            yield from walk_files(subdir)
+
+def iter_files(root):
+    """Yield an os.DirEntry for every regular file under root"""
+    for _, entries in walk_files(root):
+        yield from entries
+
+def file_suffix(name):
+    """Return the lowercased extension of a file name, following Path.suffix rules"""
+    i = name.rfind('.')
+    if 0 < i < len(name) - 1:
+        return name[i:].lower()
+    return ''
+
+def unlink_batch(dirpath, names, missing_ok=False):
+    """Unlink a batch of file names inside dirpath, returning how many were removed"""
+    removed = 0
+    unlink = os.unlink  # local lookup in the per-file loops
+    
+    if not UNLINK_DIR_FD:
+        for name in names:
+            file_path = os.path.join(dirpath, name)
+            try:
+                unlink(file_path)
+                removed += 1
+            except OSError as e:
+                if not (missing_ok and isinstance(e, FileNotFoundError)):
+                    print(f"Failed to remove {file_path}: {e}")
+        return removed
+    
+    # Resolve the directory once and unlinkat() each name relative to it
+    try:
+        dir_fd = os.open(dirpath, os.O_RDONLY | os.O_DIRECTORY)
+    except OSError as e:
+        print(f"Failed to open {dirpath}: {e}")
+        return removed
+    
+    try:
+        for name in names:
+            try:
+                unlink(name, dir_fd=dir_fd)
+                removed += 1
+            except OSError as e:
+                if not (missing_ok and isinstance(e, FileNotFoundError)):
+                    print(f"Failed to remove {os.path.join(dirpath, name)}: {e}")
+    finally:
+        os.close(dir_fd)
+    
+    return removed
+
+@lru_cache(maxsize=None)
+def gnu_find():
+    """Return the path of GNU find if it is installed, otherwise None"""
+    find = shutil.which('find')
+    if find is None:
+        return None
+    try:
+        result = subprocess.run([find, '--version'], capture_output=True, text=True)
+    except OSError:
+        return None
+    return find if 'GNU findutils' in result.stdout else None
+
+def find_start(directory):
+    """Make sure find never mistakes the start directory for an option"""
+    directory = os.fspath(directory)
+    return directory if not directory.startswith('-') else os.path.join('.', directory)
+
+def find_remove_files(find, extract_dir, keep_extensions, pbar):
+    """Delete non-kept files with GNU find, returning (kept, removed) counts"""
+    keep_match = []
+    for ext in keep_extensions:
+        keep_match += ['-o', '-iname', f'*{ext}']
+    
+    # One marker byte per file: 'k' for kept, 'd' for successfully deleted.
+    # -H follows the start path when it is a symlink to the real dataset directory
+    cmd = [find, '-H', find_start(extract_dir), '-type', 'f', '(',
+           '(', *keep_match[1:], ')', '-printf', 'k', '-o', '-delete', '-printf', 'd', ')']
+    kept = removed = 0
+    with subprocess.Popen(cmd, stdout=subprocess.PIPE) as proc:
+        for chunk in iter(lambda: proc.stdout.read1(65536), b''):
+            kept += chunk.count(b'k')
+            deleted = chunk.count(b'd')
+            removed += deleted
+            pbar.update(deleted)
+    
+    if proc.returncode:
+        print(f"find reported errors while removing files (exit code {proc.returncode})")
+    return kept, removed
+
+def find_remove_empty_dirs(find, directory):
+    """Delete empty directories bottom-up with GNU find, returning how many were removed"""
+    # A symlinked start directory is followed but cannot be removed itself
+    depth = ['-mindepth', '1'] if os.path.islink(directory) else []
+    cmd = [find, '-H', find_start(directory), *depth, '-type', 'd', '-empty', '-delete',
+           '-printf', 'x']
+    result = subprocess.run(cmd, stdout=subprocess.PIPE)
+    return len(result.stdout)
+
 def remove_empty_dirs(directory):
     """Remove empty directories recursively"""
-    directory = Path(directory)
     removed_dirs = []
     
-    for dirpath, _, _ in os.walk(directory, topdown=False):
-        dir_path = Path(dirpath)
+    def prune(dirpath):
+        # One scandir per directory; a subdirectory counts as content unless it was removed
+        subdirs = []
+        remaining = 0
         try:
-            # Only remove if empty (no files and no subdirs)
-            if not any(dir_path.iterdir()):
-                dir_path.rmdir()
-                removed_dirs.append(dir_path)
-        except OSError:
-            print(f"Could not remove directory {dir_path}: {e}")
+            with os.scandir(dirpath) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.path)
+                    else:
+                        remaining += 1
+        except OSError as e:
+            print(f"Could not scan directory {dirpath}: {e}")
+            return False
+        
+        for subdir in subdirs:
+            if not prune(subdir):
+                remaining += 1
+        
+        if remaining:
+            return False
+        
+        try:
+            os.rmdir(dirpath)
+        except OSError as e:
+            print(f"Could not remove directory {dirpath}: {e}")
+            return False
+        removed_dirs.append(dirpath)
+        return True
     
+    prune(os.fspath(directory))
     return removed_dirs
 
-def cleanup_extracted(extract_dir="extracted", dry_run=False, keep_extensions=None):
+def iter_removable(root, keep_extensions, stats, recursive=True):
+    """Yield (dirpath, names) batches of files to remove, tallying totals into stats"""
+    keep_suffixes = tuple(ext.lower() for ext in keep_extensions)
+    tail = max((len(ext) for ext in keep_suffixes), default=0)
+    
+    for dirpath, entries in walk_files(root, recursive):
+        names = []
+        for entry in entries:
+            name = entry.name
+            # Exact-case hits need no allocation; only lowercase the tail on a miss
+            if name.endswith(keep_suffixes) or name[-tail:].lower().endswith(keep_suffixes):
+                stats.keep_count += 1
+            else:
+                stats.remove_bytes += entry.stat(follow_symlinks=False).st_size
+                names.append(name)
+        if names:
+            stats.remove_count += len(names)
+            yield dirpath, names
+
+def scan_subtree(root, keep_extensions):
+    """Count the files to keep and remove under root"""
+    stats = ScanStats()
+    for _ in iter_removable(root, keep_extensions, stats):
+        pass
+    return stats
+
+def count_removable(root, keep_extensions):
+    """Count the files to keep and remove, scanning each top-level subdirectory on its own thread"""
+    stats = ScanStats()
+    for _ in iter_removable(root, keep_extensions, stats, recursive=False):
+        pass
+    
+    # Extracted tars usually sit side by side, so the subtrees are disjoint units of work
+    with os.scandir(root) as it:
+        subdirs = [entry.path for entry in it if entry.is_dir(follow_symlinks=False)]
+    if subdirs:
+        with ThreadPoolExecutor(max_workers=min(16, len(subdirs))) as executor:
+            for subtree_stats in executor.map(scan_subtree, subdirs, repeat(keep_extensions)):
+                stats.merge(subtree_stats)
+    
+    return stats
+
+def unlink_batches(batches, threads, pbar=None, missing_ok=False):
+    """Unlink (dirpath, names) batches on a thread pool, returning how many files were removed"""
+    removed_count = 0
+    pending = {}
+    
+    def reap(futures):
+        nonlocal removed_count
+        for future in futures:
+            removed_count += future.result()
+            count = pending.pop(future)
+            if pbar is not None:
+                pbar.update(count)
+    
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        for dirpath, names in batches:
+            for i in range(0, len(names), UNLINK_BATCH_SIZE):
+                batch = names[i:i + UNLINK_BATCH_SIZE]
+                pending[executor.submit(unlink_batch, dirpath, batch, missing_ok)] = len(batch)
+                # Bound the work in flight so the scan never runs far ahead
+                if len(pending) >= threads * 2:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    reap(done)
+        reap(as_completed(list(pending)))
+    
+    return removed_count
+
+def group_removable(file_names, extract_dir, keep_extensions):
+    """Yield (dirpath, names) batches of extracted file names that cleanup would remove"""
+    keep_suffixes = tuple(ext.lower() for ext in keep_extensions)
+    by_dir = {}
+    
+    for file_name in file_names:
+        # Never touch anything the extractor would not have written under extract_dir
+        rel_path = os.path.normpath(file_name)
+        if os.path.isabs(rel_path) or rel_path.split(os.sep, 1)[0] == '..':
+            continue
+        dirname, name = os.path.split(rel_path)
+        if not name.lower().endswith(keep_suffixes):
+            # A name repeated in the archive is still only one file on disk
+            by_dir.setdefault(os.path.join(extract_dir, dirname), {})[name] = None
+    
+    return ((dirpath, list(names)) for dirpath, names in by_dir.items())
+
+class BackgroundCleanup:
+    """Remove the non-kept files of each extracted tar on a background thread"""
+    
+    def __init__(self, extract_dir, keep_extensions=None, threads=None):
+        self.extract_dir = extract_dir
+        self.keep_extensions = keep_extensions if keep_extensions is not None else ['.mp4']
+        self.threads = threads if threads is not None else DEFAULT_THREADS
+        self.removed_count = 0
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+    
+    def submit(self, tar_path, file_names):
+        """Queue the regular file names a finished tar extracted"""
+        self._queue.put((tar_path, file_names))
+    
+    def close(self):
+        """Wait for queued tars to be cleaned up and return the number of files removed"""
+        self._queue.put(None)
+        self._thread.join()
+        return self.removed_count
+    
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            tar_path, file_names = item
+            try:
+                batches = group_removable(file_names, self.extract_dir, self.keep_extensions)
+                # Anything already gone was removed by an earlier tar sharing the path
+                self.removed_count += unlink_batches(batches, self.threads, missing_ok=True)
+            except Exception as e:
+                print(f"Background cleanup of {os.path.basename(tar_path)} failed: {e}")
+
+def cleanup_extracted(extract_dir="extracted", dry_run=False, keep_extensions=None, threads=None,
+                      confirm=True, verify=False, dry_run_totals=False):
     """Remove all non-MP4 files from extracted directory"""
     
     if keep_extensions is None:
         keep_extensions = ['.mp4']
+    if threads is None:
+        threads = DEFAULT_THREADS
     
     keep_extensions = [ext.lower() for ext in keep_extensions]
     
     print(f"Scanning {extract_dir}...")
-    extract_path = Path(extract_dir)
-    
-    if not extract_path.exists():
+    if not os.path.isdir(extract_dir):
         print(f"Directory {extract_dir} does not exist")
         return
     
-    keep_files = []
-    remove_files = []
-    
-    for file_path in extract_path.rglob("*"):
-        if file_path.is_file():
-            if file_path.suffix.lower() in keep_extensions:
-                keep_files.append(file_path)
-            else:
-                remove_files.append(file_path)
-    
-    print(f"Found {len(keep_files)} files to keep ({', '.join(keep_extensions)})")
-    print(f"Found {len(remove_files)} files to remove")
-    
-    if not remove_files:
-        print("No files to remove!")
-        return
+    stats = ScanStats()
+    batches = iter_removable(extract_dir, keep_extensions, stats)
     
     if dry_run:
         print("=== DRY RUN - Files that would be removed: ===")
-        for file_path in remove_files[:20]:  # Show first 20
+        paths = (os.path.join(dirpath, name) for dirpath, names in batches for name in names)
+        shown = list(islice(paths, 21))
+        for file_path in shown[:20]:  # Show first 20
             print(f"  {file_path}")
-        if len(remove_files) > 20:
-            print(f"  ... and {len(remove_files) - 20} more files")
+        if not shown:
+            print("No files to remove!")
+        
+        # Stop here unless totals were asked for; counting them means walking the whole tree
+        if not dry_run_totals:
+            if len(shown) > 20:
+                print("  ... and more files (use --dry-run-totals to count them)")
+            return
+        
+        stats = count_removable(extract_dir, keep_extensions)
+        if stats.remove_count > 20:
+            print(f"  ... and {stats.remove_count - 20} more files")
+        print(f"Found {stats.keep_count} files to keep ({', '.join(keep_extensions)})")
+        print(f"Found {stats.remove_count} files to remove")
         return
     
-    total_size = sum(f.stat().st_size for f in remove_files)
-    size_mb = total_size / (1024 * 1024)
+    if confirm:
+        # Totals are needed before prompting, so count first and walk again to delete
+        totals = count_removable(extract_dir, keep_extensions)
+        
+        print(f"Found {totals.keep_count} files to keep ({', '.join(keep_extensions)})")
+        print(f"Found {totals.remove_count} files to remove")
+        
+        if not totals.remove_count:
+            print("No files to remove!")
+            return
+        
+        size_mb = totals.remove_bytes / (1024 * 1024)
+        
+        print(f"This will delete {totals.remove_count} files ({size_mb:.1f} MB)")
+        answer = input("Continue? (y/N): ").lower().strip()
+        
+        if answer not in ['y', 'yes', '']:
+            print("Cancelled")
+            return
+        
+        total = totals.remove_count
+    else:
+        total = None
     
-    print(f"This will delete {len(remove_files)} files ({size_mb:.1f} MB)")
-    confirm = input("Continue? (y/N): ").lower().strip()
-    
-    if confirm not in ['y', 'yes', '']:
-        print("Cancelled")
-        return
+    # GNU find unlinks relative to each open directory in C; use it when it can express the filter
+    find = gnu_find() if keep_extensions else None
     
     print("Removing files...")
-    removed_count = 0
+    with tqdm(total=total, desc="Removing files", unit="file", mininterval=0.5) as pbar:
+        if find:
+            stats.keep_count, removed_count = find_remove_files(find, extract_dir,
+                                                                keep_extensions, pbar)
+            # find exits cleanly when it never reaches the files, so check it saw them
+            if not removed_count and (total or (not stats.keep_count
+                                                and next(iter_files(extract_dir), None))):
+                raise RuntimeError(f"find removed no files from {extract_dir} although "
+                                   f"files to remove were found")
+            stats.remove_count = total if total is not None else removed_count
+        else:
+            removed_count = unlink_batches(batches, threads, pbar)
     
-    with tqdm(total=len(remove_files), desc="Removing files", unit="file") as pbar:
-        for file_path in remove_files:
-            try:
-                file_path.unlink()
-                removed_count += 1
-            except OSError as e:
-                print(f"Failed to remove {file_path}: {e}")
-            pbar.update(1)
+    if not confirm:
+        print(f"Found {stats.keep_count} files to keep ({', '.join(keep_extensions)})")
+        print(f"Found {stats.remove_count} files to remove")
     
-    print(f"Removed {removed_count}/{len(remove_files)} files")
+    # Still prune directories; files may already have gone through BackgroundCleanup
+    if stats.remove_count:
+        print(f"Removed {removed_count}/{stats.remove_count} files")
+    else:
+        print("No files to remove!")
     
     print("Removing empty directories...")
-    removed_dirs = remove_empty_dirs(extract_path)
+    if find:
+        removed_dirs = find_remove_empty_dirs(find, extract_dir)
+    else:
+        removed_dirs = len(remove_empty_dirs(extract_dir))
     if removed_dirs:
-        print(f"Removed {len(removed_dirs)} empty directories")
+        print(f"Removed {removed_dirs} empty directories")
+    
+    print(f"Cleanup complete! {stats.keep_count} {', '.join(keep_extensions)} files remaining")
     
-    remaining_mp4s = list(extract_path.rglob("*.mp4"))
-    print(f"Cleanup complete! {len(remaining_mp4s)} MP4 files remaining")
+    if verify and os.path.isdir(extract_dir):
+        remaining = sum(1 for _ in iter_files(extract_dir))
+        print(f"Verified: {remaining} files left on disk")
 
 if __name__ == "__main__":
     cleanup_extracted("dataset")
\ No newline at end of file
@@ -3,25 +3,77 @@ Script to convert dataset links TSV file to Python-friendly format
 """
 
 import json
-import csv
+import mmap
+import os
+import pickle
 from pathlib import Path
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def read_links_tsv(f):
+    """Parse an open links TSV file, returning (links, number of rows skipped)"""
+    dataset_links = {}
+    skipped = 0
+    
+    # The links file is plain, unquoted TSV, so split lines and fields directly
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        size = len(mm)
+        header_end = mm.find(b'\n')
+        if header_end == -1:
+            header_end = size
+        header = mm[:header_end].rstrip(b'\r').split(b'\t')
+        i_name = header.index(b'file_name')
+        i_link = header.index(b'cdn_link')
+        max_split = max(i_name, i_link) + 1
+        
+        pos = header_end + 1
+        while pos < size:
+            nl = mm.find(b'\n', pos)
+            if nl == -1:
+                nl = size
+            line = mm[pos:nl].rstrip(b'\r')
+            pos = nl + 1
+            if not line:
+                continue
+            fields = line.split(b'\t', max_split)
+            if len(fields) < max_split:
+                skipped += 1
+                continue
+            dataset_links[fields[i_name].decode('utf-8')] = fields[i_link].decode('utf-8')
+    
+    return dataset_links, skipped
+
 def convert_tsv_to_json(input_file="dataset links.txt"):
     """Convert TSV file to JSON format"""
     
     dataset_links = {}
+    skipped = 0
+    
+    with open(input_file, 'rb') as f:
+        # mmap refuses empty files, and an empty TSV simply has no links
+        if os.fstat(f.fileno()).st_size:
+            dataset_links, skipped = read_links_tsv(f)
+    
+    if skipped:
+        print(f"Skipped {skipped} rows with missing columns")
     
-    with open(input_file, 'r', encoding='utf-8') as f:
-        reader = csv.DictReader(f, delimiter='\t')
-        for row in reader:
-            dataset_links[row['file_name']] = row['cdn_link']
+    if orjson is not None:
+        Path('dataset_links.json').write_bytes(orjson.dumps(dataset_links))
+    else:
+        with open('dataset_links.json', 'w', encoding='utf-8') as f:
+            json.dump(dataset_links, f, separators=(',', ':'), ensure_ascii=False)
     
-    with open('dataset_links.json', 'w', encoding='utf-8') as f:
-        json.dump(dataset_links, f, indent=2)
+    # Written after the JSON so it is never older than it; loaders prefer it when fresh
+    with open('dataset_links.pkl', 'wb') as f:
+        pickle.dump(dataset_links, f, protocol=pickle.HIGHEST_PROTOCOL)
     
     print(f"Converted {len(dataset_links)} entries")
-    print("Created file:")
+    print("Created files:")
     print("- dataset_links.json (JSON format)")
+    print("- dataset_links.pkl (snapshot for faster reloads)")
     
     return dataset_links
 
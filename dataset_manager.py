@@ -5,13 +5,15 @@ Handles conversion, downloading, and extraction of dataset files
 """
 
 import argparse
+import os
 import sys
+from collections import Counter
 from pathlib import Path
 
 from convert_dataset_links import convert_tsv_to_json   
 from download_dataset import download_multiple_files, list_available_files
-from extract_dataset import extract_all_tars, extract_specific_files, get_tar_files
-from cleanup_dataset import cleanup_extracted
+from extract_dataset import TAR_SUFFIXES, extract_all_tars, extract_specific_files, get_tar_files
+from cleanup_dataset import BackgroundCleanup, cleanup_extracted, iter_files, file_suffix
 
 def setup_directories(downloads_dir, dataset_dir):
     """Create necessary directories"""
@@ -32,7 +34,8 @@ def convert_step(tsv_file):
         print(f"Error converting TSV: {e}")
         return False
 
-def download_step(files, downloads_dir, max_files=None):
+def download_step(files, downloads_dir, max_files=None, workers=4, checksum=False,
+                  recv_buffer=None):
     """Step 2: Download files"""
     print("=== STEP 2: Downloading Files ===")
     setup_directories(downloads_dir, "")
@@ -49,10 +52,12 @@ def download_step(files, downloads_dir, max_files=None):
                 print(f"Downloading first {len(available_files)} files (limited by --max-files)...")
             else:
                 print(f"Downloading all {len(available_files)} files...")
-            results = download_multiple_files(available_files, downloads_dir)
+            results = download_multiple_files(available_files, downloads_dir, workers=workers,
+                                              checksum=checksum, recv_buffer=recv_buffer)
         else:
             print(f"Downloading {len(files)} files...")
-            results = download_multiple_files(files, downloads_dir)
+            results = download_multiple_files(files, downloads_dir, workers=workers,
+                                              checksum=checksum, recv_buffer=recv_buffer)
         
         successful = sum(1 for success in results.values() if success)
         total = len(results)
@@ -63,7 +68,7 @@ def download_step(files, downloads_dir, max_files=None):
         print(f"Error during download: {e}")
         return False
 
-def extract_step(files, downloads_dir, dataset_dir):
+def extract_step(files, downloads_dir, dataset_dir, on_extracted=None, workers=None):
     """Step 3: Extract files"""
     print("=== STEP 3: Extracting Files ===")
     setup_directories("", dataset_dir)
@@ -75,34 +80,30 @@ def extract_step(files, downloads_dir, dataset_dir):
     
     try:
         if files == ["all"]:
-            results = extract_all_tars(downloads_dir, dataset_dir)
+            results = extract_all_tars(downloads_dir, dataset_dir, tar_files=available_tars,
+                                       on_extracted=on_extracted, workers=workers)
         else:
-            tar_files = [f for f in files if f.endswith('.tar')]
+            tar_files = [f for f in files if f.endswith(TAR_SUFFIXES)]
             if not tar_files:
-                print("No .tar files specified for extraction")
+                print("No tar files specified for extraction")
                 return False
-            results = extract_specific_files(tar_files, downloads_dir, dataset_dir)
+            results = extract_specific_files(tar_files, downloads_dir, dataset_dir,
+                                             on_extracted=on_extracted)
         
         return any(results.values()) if results else False
     except Exception as e:
         print(f"Error during extraction: {e}")
         return False
 
-def cleanup_step(dataset_dir, keep_extensions, auto=False):
+def cleanup_step(dataset_dir, keep_extensions, auto=False, threads=None, verify=False,
+                 dry_run=False, dry_run_totals=False):
     """Step 4: Cleanup extracted files"""
     print("=== STEP 4: Cleaning up extracted files ===")
     
     try:
-        if auto:
-            import builtins
-            original_input = builtins.input
-            builtins.input = lambda _: 'y'
-        
-        cleanup_extracted(dataset_dir, dry_run=False, keep_extensions=keep_extensions)
-        
-        if auto:
-            builtins.input = original_input
-        
+        cleanup_extracted(dataset_dir, dry_run=dry_run, keep_extensions=keep_extensions,
+                          threads=threads, confirm=not auto, verify=verify,
+                          dry_run_totals=dry_run_totals)
         return True
     except Exception as e:
         print(f"Error during cleanup: {e}")
@@ -113,51 +114,42 @@ def show_summary(downloads_dir="downloads", dataset_dir="dataset"):
     print("=== SUMMARY ===")
 
     # Check downloads
-    downloads_path = Path(downloads_dir)
-    if downloads_path.exists():
-        tar_files = list(downloads_path.glob("*.tar"))
+    if os.path.isdir(downloads_dir):
+        tar_files = get_tar_files(downloads_dir)
         print(f"Downloads: {len(tar_files)} files in {downloads_dir}/")
         if tar_files:
-            total_size = sum(f.stat().st_size for f in tar_files)
+            total_size = sum(os.path.getsize(f) for f in tar_files)
             size_gb = total_size / (1024**3)
             print(f"    Total size: {size_gb:.2f} GB")
     else:
         print(f"Downloads: {downloads_dir}/ folder not found")
     
     # Check dataset
-    dataset_path = Path(dataset_dir)
-    if dataset_path.exists():
+    if os.path.isdir(dataset_dir):
         # Count by extension
-        extensions = {}
-        total_files = 0
+        counts = Counter()
+        sizes = Counter()
         total_size = 0
         
-        for file_path in dataset_path.rglob("*"):
-            if file_path.is_file():
-                ext = file_path.suffix.lower() or 'no extension'
-                size = file_path.stat().st_size
-                
-                if ext not in extensions:
-                    extensions[ext] = {'count': 0, 'size': 0}
-                
-                extensions[ext]['count'] += 1
-                extensions[ext]['size'] += size
-                total_files += 1
-                total_size += size
+        for entry in iter_files(dataset_dir):
+            ext = sys.intern(file_suffix(entry.name) or 'no extension')
+            size = entry.stat(follow_symlinks=False).st_size
+            counts[ext] += 1
+            sizes[ext] += size
+            total_size += size
         
+        total_files = sum(counts.values())
         if total_files > 0:
             size_gb = total_size / (1024**3)
             print(f"Dataset: {total_files} files in {dataset_dir}/ ({size_gb:.2f} GB)")
             
             # Show top file types
-            sorted_ext = sorted(extensions.items(), key=lambda x: x[1]['count'], reverse=True)
-            for ext, data in sorted_ext[:5]:  # Show top 5
-                count = data['count']
-                size_mb = data['size'] / (1024**2)
+            for ext, count in counts.most_common(5):  # Show top 5
+                size_mb = sizes[ext] / (1024**2)
                 print(f"    {ext}: {count} files ({size_mb:.1f} MB)")
             
-            if len(sorted_ext) > 5:
-                print(f"    ... and {len(sorted_ext) - 5} more file types")
+            if len(counts) > 5:
+                print(f"    ... and {len(counts) - 5} more file types")
         else:
             print(f"Dataset: {dataset_dir}/ folder is empty")
     else:
@@ -231,8 +223,26 @@ Examples:
                        help='File extensions to keep during cleanup (default: .mp4)')
     parser.add_argument('--auto-cleanup', action='store_true',
                        help='Skip confirmation prompt during cleanup')
+    parser.add_argument('--dry-run', action='store_true',
+                       help='Show the first files cleanup would remove without deleting anything')
+    parser.add_argument('--dry-run-totals', action='store_true',
+                       help='With --dry-run, also scan the whole dataset to count files to remove')
+    parser.add_argument('--verify', action='store_true',
+                       help='Re-scan the dataset directory after cleanup to count remaining files')
     parser.add_argument('--max-files', type=int, metavar='N',
                        help='Maximum number of files to download (useful for testing)')
+    parser.add_argument('--workers', type=int, default=4, metavar='N',
+                       help='Number of files to download in parallel (default: 4)')
+    parser.add_argument('--checksum', action='store_true',
+                       help='Write a SHA-256 checksum file (.sha256) next to each download')
+    parser.add_argument('--recv-buffer', type=int, metavar='BYTES',
+                       help='Fixed socket receive buffer for downloads, e.g. 4194304 for '
+                            'high-latency links (default: let the OS tune it)')
+    parser.add_argument('--extract-workers', type=int, metavar='N',
+                       help='Number of tar files to extract in parallel (default: one per CPU)')
+    parser.add_argument('--threads', type=int, metavar='N',
+                       help='Number of threads used to delete files during cleanup when GNU '
+                            'find is not available (default: 4 per CPU, up to 32)')
     
     args = parser.parse_args()
     
@@ -241,16 +251,33 @@ Examples:
         return
     
     success = True
+    dry_run = args.dry_run or args.dry_run_totals
     
     if args.all:
         print("Running full pipeline...")
         success &= convert_step(args.tsv_file)
         if success:
-            success &= download_step(["all"], args.downloads_dir, args.max_files)
-        if success:
-            success &= extract_step(["all"], args.downloads_dir, args.dataset_dir)
+            success &= download_step(["all"], args.downloads_dir, args.max_files, args.workers,
+                                     args.checksum, args.recv_buffer)
+        if success and dry_run:
+            success &= extract_step(["all"], args.downloads_dir, args.dataset_dir,
+                                    workers=args.extract_workers)
+        elif success:
+            # Clean each tar's extracted files while the next one is being extracted
+            background = BackgroundCleanup(args.dataset_dir, args.keep_extensions, args.threads)
+            try:
+                success &= extract_step(["all"], args.downloads_dir, args.dataset_dir,
+                                        on_extracted=background.submit,
+                                        workers=args.extract_workers)
+            finally:
+                removed = background.close()
+            print(f"Removed {removed} files while extracting")
         if success:
-            success &= cleanup_step(args.dataset_dir, args.keep_extensions, auto=True)
+            # Sweep anything left over and prune empty directories
+            success &= cleanup_step(args.dataset_dir, args.keep_extensions, auto=True,
+                                    threads=args.threads, verify=args.verify,
+                                    dry_run=dry_run,
+                                    dry_run_totals=args.dry_run_totals)
     else:
         # Handle individual steps
         if args.convert:
@@ -258,14 +285,19 @@ Examples:
         
         if args.download is not None:
             files = args.download if args.download else ["all"]
-            success &= download_step(files, args.downloads_dir, args.max_files)
+            success &= download_step(files, args.downloads_dir, args.max_files, args.workers,
+                                     args.checksum, args.recv_buffer)
         
         if args.extract is not None:
             files = args.extract if args.extract else ["all"]
-            success &= extract_step(files, args.downloads_dir, args.dataset_dir)
+            success &= extract_step(files, args.downloads_dir, args.dataset_dir,
+                                    workers=args.extract_workers)
         
         if args.cleanup:
-            success &= cleanup_step(args.dataset_dir, args.keep_extensions, args.auto_cleanup)
+            success &= cleanup_step(args.dataset_dir, args.keep_extensions, args.auto_cleanup,
+                                    threads=args.threads, verify=args.verify,
+                                    dry_run=dry_run,
+                                    dry_run_totals=args.dry_run_totals)
     
     if args.summary:
         show_summary(args.downloads_dir, args.dataset_dir)
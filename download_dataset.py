@@ -2,59 +2,326 @@
 Dataset downloader utility
 """
 
+import hashlib
 import requests
+import shutil
+import socket
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 import json
+import pickle
+from functools import lru_cache
+from requests.adapters import HTTPAdapter
 from tqdm import tqdm
+from urllib3.connection import HTTPConnection
+from urllib3.util.retry import Retry
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+DEFAULT_POOL_SIZE = 16
+
+class SocketOptionsAdapter(HTTPAdapter):
+    """HTTPAdapter that applies extra socket options to every new connection"""
+    
+    def __init__(self, *args, socket_options=None, **kwargs):
+        # Set before super().__init__, which builds the pool manager
+        self.socket_options = socket_options
+        super().__init__(*args, **kwargs)
+    
+    def init_poolmanager(self, *args, **kwargs):
+        if self.socket_options:
+            kwargs['socket_options'] = HTTPConnection.default_socket_options + self.socket_options
+        super().init_poolmanager(*args, **kwargs)
+
+def create_session(pool_size=DEFAULT_POOL_SIZE, recv_buffer=None):
+    """Create a session that keeps connections alive and retries transient failures"""
+    session = requests.Session()
+    retry = Retry(total=5, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504])
+    # A fixed SO_RCVBUF turns off Linux receive buffer autotuning and is capped by
+    # net.core.rmem_max, so it is only set when asked for
+    socket_options = [(socket.SOL_SOCKET, socket.SO_RCVBUF, recv_buffer)] if recv_buffer else None
+    adapter = SocketOptionsAdapter(pool_connections=pool_size, pool_maxsize=pool_size,
+                                   max_retries=retry, socket_options=socket_options)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+# Shared by default so consecutive downloads reuse keep-alive connections
+default_session = create_session(DEFAULT_POOL_SIZE)
 
 def load_dataset_links(json_file="dataset_links.json"):
-    """Load dataset links from JSON file"""
-    with open(json_file, 'r', encoding='utf-8') as f:
-        return json.load(f)
+    """Load dataset links from JSON file, or from its pickle snapshot if that is up to date"""
+    json_path = Path(json_file)
+    snapshot = json_path.with_suffix('.pkl')
+    st = json_path.stat()
+    
+    # The snapshot is written by convert_tsv_to_json right after the JSON
+    if snapshot.exists():
+        snapshot_st = snapshot.stat()
+        if snapshot_st.st_mtime >= st.st_mtime:
+            return load_links_file(str(snapshot), snapshot_st.st_mtime_ns, snapshot_st.st_size)
+    
+    return load_links_file(str(json_path), st.st_mtime_ns, st.st_size)
+
+# Parsed once per process; keying on mtime and size picks up a rewritten file
+@lru_cache(maxsize=4)
+def load_links_file(path, mtime_ns, size):
+    """Parse a links file (.pkl snapshot or JSON); mtime_ns and size only key the cache"""
+    if path.endswith('.pkl'):
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+    
+    data = Path(path).read_bytes()
+    if orjson is not None:
+        return orjson.loads(data)
+    # json.loads decodes UTF-8 bytes itself, so skip the text-mode wrapper
+    return json.loads(data)
+
+def sha256_file(path):
+    """Return the hex SHA-256 digest of a file"""
+    with open(path, 'rb') as f:
+        if hasattr(hashlib, 'file_digest'):
+            # Hashes in C straight from the file, using SHA-NI where OpenSSL supports it
+            return hashlib.file_digest(f, 'sha256').hexdigest()
+        h = hashlib.sha256()
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+        return h.hexdigest()
+
+def copy_readinto(src, dst, chunk_size, pbar):
+    """Copy src to dst through one reused buffer instead of a new bytes object per chunk"""
+    buf = memoryview(bytearray(chunk_size))
+    while True:
+        n = src.readinto(buf)
+        if not n:
+            break
+        # dst is unbuffered, so one write() may store only part of the slice
+        view = buf[:n]
+        while view:
+            view = view[dst.write(view):]
+        pbar.update(n)
+
+def write_checksum(path):
+    """Write a sha256sum-compatible .sha256 file next to path"""
+    digest = sha256_file(path)
+    path.with_name(path.name + '.sha256').write_text(f"{digest}  {path.name}\n")
+
+def matches_remote_size(session, url, path):
+    """Check with a HEAD request whether path already has the remote file's size"""
+    try:
+        head = session.head(url, allow_redirects=True, timeout=(5, 60))
+    except requests.RequestException:
+        return False
+    head.close()
+    size = head.headers.get('content-length')
+    return head.ok and size is not None and int(size) == path.stat().st_size
+
+def range_validator(headers):
+    """Return the response's validator for If-Range: a strong ETag, else Last-Modified"""
+    etag = headers.get('etag')
+    if etag and not etag.startswith('W/'):
+        return etag
+    return headers.get('last-modified')
+
+def already_downloaded(output_path, checksum=False):
+    """Report a download that is already complete, adding its checksum file if asked"""
+    if checksum and not output_path.with_name(output_path.name + '.sha256').exists():
+        write_checksum(output_path)
+    tqdm.write(f"Already downloaded {output_path}")
+    return True
+
+def finish_download(part_path, output_path, etag=None, checksum=False):
+    """Move a complete .part file into place and update the files kept beside it"""
+    part_path.replace(output_path)
+    validator_path = output_path.with_name(output_path.name + '.part.validator')
+    if validator_path.exists():
+        validator_path.unlink()
+    # Lets the next run ask for the file only if it changed
+    etag_path = output_path.with_name(output_path.name + '.etag')
+    if etag:
+        etag_path.write_text(etag)
+    elif etag_path.exists():
+        etag_path.unlink()
+    # An old sidecar next to new content would make sha256sum -c report a mismatch
+    checksum_path = output_path.with_name(output_path.name + '.sha256')
+    if checksum:
+        write_checksum(output_path)
+    elif checksum_path.exists():
+        checksum_path.unlink()
+    tqdm.write(f"Downloaded to {output_path}")
+    return True
 
-def download_dataset_file(filename, output_dir="downloads", links_file="dataset_links.json"):
+def download_dataset_file(filename, output_dir="downloads", links_file="dataset_links.json",
+                          session=None, chunk_size=1024 * 1024, progress=True, checksum=False):
     """Download a specific dataset file"""
+    if session is None:
+        session = default_session
+    
     Path(output_dir).mkdir(exist_ok=True)
     
     dataset_links = load_dataset_links(links_file)
     
     if filename not in dataset_links:
-        print(f"File {filename} not found in dataset")
+        tqdm.write(f"File {filename} not found in dataset")
         return False
     
     url = dataset_links[filename]
     output_path = Path(output_dir) / filename
+    part_path = output_path.with_name(filename + '.part')
+    etag_path = output_path.with_name(filename + '.etag')
+    validator_path = output_path.with_name(filename + '.part.validator')
+    
+    # Pick up where an interrupted download stopped, but only if the server can tell
+    # us via If-Range whether the partial bytes still belong to the current file
+    existing = part_path.stat().st_size if part_path.exists() else 0
+    validator = validator_path.read_text().strip() if validator_path.exists() else None
+    if existing and validator:
+        # A changed file comes back as a full 200 instead of a 206
+        headers = {'Range': f'bytes={existing}-', 'If-Range': validator}
+    else:
+        existing = 0
+        headers = {}
     
-    print(f"Downloading {filename}...")
-    response = requests.get(url, stream=True)
+    if not existing and output_path.exists():
+        if etag_path.exists():
+            # The server answers 304 if the file has not changed since it was downloaded
+            headers['If-None-Match'] = etag_path.read_text().strip()
+        elif matches_remote_size(session, url, output_path):
+            return already_downloaded(output_path, checksum)
     
-    if response.status_code == 200:
-        total_size = int(response.headers.get('content-length', 0))
+    tqdm.write(f"Downloading {filename}...")
+    response = session.get(url, stream=True, timeout=(5, 60), headers=headers)
+    
+    # Always close the response so failed transfers never pin a pooled connection
+    try:
+        if response.status_code == 304:
+            return already_downloaded(output_path, checksum)
         
-        with open(output_path, 'wb') as f, tqdm(
-            desc=filename,
-            total=total_size,
+        if response.status_code == 416 and existing:
+            response.close()
+            if response.headers.get('content-range') == f'bytes */{existing}':
+                # The partial file already holds every byte; a 416 rather than a 200
+                # also means If-Range matched, so a validator that is an ETag is current
+                etag = response.headers.get('etag')
+                if not etag and validator.startswith('"'):
+                    etag = validator
+                return finish_download(part_path, output_path, etag, checksum)
+            existing = 0
+            response = session.get(url, stream=True, timeout=(5, 60))
+        
+        if response.status_code == 206:
+            if not response.headers.get('content-range', '').startswith(f'bytes {existing}-'):
+                tqdm.write(f"Failed to download {filename}: unexpected range "
+                           f"{response.headers.get('content-range')}")
+                return False
+            mode = 'ab'
+        elif response.status_code == 200:
+            # Full body, either requested, because the file changed, or because the
+            # server ignored the range
+            existing = 0
+            mode = 'wb'
+            validator = range_validator(response.headers)
+            if validator:
+                validator_path.write_text(validator)
+            elif validator_path.exists():
+                validator_path.unlink()
+        else:
+            tqdm.write(f"Failed to download {filename}: {response.status_code}")
+            return False
+        
+        content_length = int(response.headers.get('content-length', 0))
+        total_size = existing + content_length if content_length else 0
+        
+        # Fail before transferring anything rather than hitting ENOSPC part way through
+        free_space = shutil.disk_usage(output_dir).free
+        if content_length > free_space:
+            tqdm.write(f"Failed to download {filename}: needs {content_length} bytes, "
+                       f"only {free_space} free in {output_dir}")
+            return False
+        
+        progress_options = dict(
             unit='B',
             unit_scale=True,
             unit_divisor=1024,
-        ) as pbar:
-            for chunk in response.iter_content(chunk_size=8192):
-                if chunk:
+            total=total_size,
+            initial=existing,
+            desc=filename,
+            disable=not progress,
+            # Redraw at most 4 times a second and only after another MiB
+            mininterval=0.25,
+            miniters=1 << 20,
+        )
+        
+        # A decoded body no longer matches the encoded Content-Length
+        encoded = response.headers.get('content-encoding', 'identity') != 'identity'
+        # http.client's response under urllib3 can read the socket straight into our buffer
+        body = getattr(response.raw, '_fp', None)
+        if not encoded and hasattr(body, 'readinto'):
+            # Writes are already chunk sized, so skip the BufferedWriter copy as well
+            with open(part_path, mode, buffering=0) as f, tqdm(**progress_options) as pbar:
+                copy_readinto(body, f, chunk_size, pbar)
+            if body.isclosed():
+                # Same as urllib3 does after reading a whole body itself
+                response.raw.release_conn()
+        else:
+            # read1 hands back whatever is decoded so far instead of waiting for a full chunk
+            response.raw.decode_content = True
+            read = getattr(response.raw, 'read1', response.raw.read)
+            # A short read from the socket is coalesced instead of becoming its own write()
+            with open(part_path, mode, buffering=1 << 20) as f, tqdm(**progress_options) as pbar:
+                while True:
+                    chunk = read(chunk_size)
+                    if not chunk:
+                        break
                     f.write(chunk)
                     pbar.update(len(chunk))
         
-        print(f"Downloaded to {output_path}")
-        return True
-    else:
-        print(f"Failed to download {filename}: {response.status_code}")
-        return False
+        written = part_path.stat().st_size
+        if total_size and not encoded and written != total_size:
+            # Keep the partial file so the next attempt resumes it
+            tqdm.write(f"Failed to download {filename}: got {written} of {total_size} bytes")
+            return False
+        
+        return finish_download(part_path, output_path, response.headers.get('etag'), checksum)
+    finally:
+        response.close()
 
-def download_multiple_files(filenames, output_dir="downloads", links_file="dataset_links.json"):
-    """Download multiple dataset files"""
+def download_multiple_files(filenames, output_dir="downloads", links_file="dataset_links.json",
+                            session=None, workers=4, checksum=False, recv_buffer=None):
+    """Download multiple dataset files, several at a time"""
+    if session is None:
+        if workers <= DEFAULT_POOL_SIZE and not recv_buffer:
+            session = default_session
+        else:
+            session = create_session(max(workers, DEFAULT_POOL_SIZE), recv_buffer)
+    
+    if workers <= 1:
+        return {filename: download_dataset_file(filename, output_dir, links_file, session,
+                                                checksum=checksum)
+                for filename in filenames}
+    
+    # Socket reads release the GIL, so threads keep several transfers in flight
     results = {}
-    for filename in filenames:
-        results[filename] = download_dataset_file(filename, output_dir, links_file)
-    return results
+    with ThreadPoolExecutor(max_workers=workers) as executor, \
+            tqdm(total=len(filenames), desc="Downloading", unit="file") as pbar:
+        futures = {
+            executor.submit(download_dataset_file, filename, output_dir, links_file, session,
+                            progress=False, checksum=checksum): filename
+            for filename in filenames
+        }
+        for future in as_completed(futures):
+            filename = futures[future]
+            try:
+                results[filename] = future.result()
+            except Exception as e:
+                tqdm.write(f"Failed to download {filename}: {e}")
+                results[filename] = False
+            pbar.update(1)
+    
+    return {filename: results[filename] for filename in filenames}
 
 def list_available_files(links_file="dataset_links.json"):
     """List all available files in the dataset"""
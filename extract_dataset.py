@@ -3,40 +3,276 @@
 Dataset extraction utility
 """
 
+import copy
+import os
+import shutil
+import subprocess
 import tarfile
+from concurrent.futures import (FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor,
+                                as_completed, wait)
+from contextlib import contextmanager
+from functools import lru_cache
+from itertools import islice
 from pathlib import Path
 from tqdm import tqdm
 
+try:
+    from isal import igzip
+except ImportError:
+    igzip = None
+
+try:
+    import libarchive
+    from libarchive.extract import PREVENT_ESCAPE, extract_entries
+except (ImportError, OSError):
+    libarchive = None
+
+EXTRACT_THREADS = 16
+# Members read into memory for the writer threads are capped in size and in total
+STREAM_MEMBER_SIZE = 16 << 20
+MAX_PENDING_BYTES = 64 << 20
+TAR_SUFFIXES = ('.tar', '.tar.gz', '.tgz')
+GZIP_SUFFIXES = ('.tar.gz', '.tgz')
+# Extraction filters arrived in 3.12 and were backported to 3.8.17+/3.9.17+/3.10.12+/3.11.4+
+EXTRACT_OPTIONS = {'filter': 'data'} if hasattr(tarfile, 'data_filter') else {}
+
+class FastTarFile(tarfile.TarFile):
+    """TarFile that skips restoring owners and timestamps on extraction"""
+    
+    def chown(self, tarinfo, targetpath, numeric_owner):
+        pass
+    
+    def utime(self, tarinfo, targetpath):
+        pass
+
+def check_link(name, linkname, symlink, dest_path):
+    """Refuse a link whose target is absolute or resolves outside dest_path"""
+    # Symlinks resolve from their own directory, hard links from the archive root
+    target = os.path.realpath(os.path.join(dest_path, name))
+    link_base = os.path.dirname(target) if symlink else dest_path
+    link_target = os.path.realpath(os.path.join(link_base, linkname))
+    if os.path.isabs(linkname) or os.path.commonpath([link_target, dest_path]) != dest_path:
+        raise tarfile.ExtractError(f"{name!r} links outside {dest_path}")
+
+if EXTRACT_OPTIONS:
+    data_filter = tarfile.data_filter
+else:
+    def data_filter(member, dest_path):
+        """Reject members that would land outside dest_path, like tarfile.data_filter"""
+        name = member.name.lstrip('/')
+        target = os.path.realpath(os.path.join(dest_path, name))
+        if os.path.commonpath([target, dest_path]) != dest_path:
+            raise tarfile.ExtractError(f"{member.name!r} would be extracted outside {dest_path}")
+        if member.ischr() or member.isblk() or member.isfifo():
+            raise tarfile.ExtractError(f"{member.name!r} is a special file")
+        if member.issym() or member.islnk():
+            check_link(name, member.linkname, member.issym(), dest_path)
+        if name != member.name:
+            member = copy.copy(member)
+            member.name = name
+        return member
+
 def get_tar_files(directory="downloads"):
-    """Get all tar files in the specified directory"""
-    tar_files = []
-    path = Path(directory)
-    if path.exists():
-        tar_files = list(path.glob("*.tar"))
-    return tar_files
-
-def extract_tar_with_progress(tar_path, extract_to="dataset"):
-    """Extract a tar file with progress bar"""
-    dataset_path = Path(extract_to)
-    dataset_path.mkdir(exist_ok=True)
-    
-    tar_name = tar_path.name
-    print(f"Extracting {tar_name}...")
-    
-    with tarfile.open(tar_path, 'r') as tar:
-        members = tar.getmembers()
-        
-        with tqdm(total=len(members), desc=tar_name, unit='file') as pbar:
-            for member in members:
-                tar.extract(member, path=dataset_path)
-                pbar.update(1)
+    """Get the paths of all tar files (plain or gzipped) in the specified directory"""
+    # scandir entries carry their file type, so is_file() needs no extra stat
+    try:
+        with os.scandir(directory) as it:
+            return [entry.path for entry in it
+                    if entry.name.endswith(TAR_SUFFIXES) and entry.is_file()]
+    except FileNotFoundError:
+        return []
+
+@lru_cache(maxsize=None)
+def find_pigz():
+    """Return the path of pigz if it is installed, otherwise None"""
+    return shutil.which('pigz')
+
+@contextmanager
+def open_tar(tar_path):
+    """Open a plain or gzipped tar for reading its members in order"""
+    tar_path = os.fspath(tar_path)
+    if not tar_path.endswith(GZIP_SUFFIXES):
+        with FastTarFile.open(tar_path, 'r') as tar:
+            yield tar
+        return
     
-    print(f"Extracted {tar_name} to {dataset_path}")
-    return True
+    pigz = find_pigz()
+    if pigz is not None:
+        # pigz decompresses in its own process, so reading the tar overlaps inflate
+        proc = subprocess.Popen([pigz, '-dc', '--', tar_path], stdout=subprocess.PIPE)
+        try:
+            with FastTarFile.open(fileobj=proc.stdout, mode='r|') as tar:
+                yield tar
+            # Drain trailing padding so pigz can exit cleanly
+            while proc.stdout.read(1 << 16):
+                pass
+        except BaseException:
+            proc.kill()
+            raise
+        finally:
+            proc.stdout.close()
+            returncode = proc.wait()
+        if returncode != 0:
+            raise tarfile.ReadError(f"pigz exited with status {returncode} for {tar_path}")
+    elif igzip is not None:
+        with igzip.open(tar_path, 'rb') as f, FastTarFile.open(fileobj=f, mode='r|') as tar:
+            yield tar
+    else:
+        with FastTarFile.open(tar_path, 'r|gz') as tar:
+            yield tar
 
-def extract_all_tars(downloads_dir="downloads", extract_to="dataset"):
-    """Extract all tar files in downloads directory"""
-    tar_files = get_tar_files(downloads_dir)
+def remove_link_target(target):
+    """Remove a file left where a hard link is about to be extracted"""
+    # When os.link() finds the path taken, tarfile falls back to re-reading the
+    # linked member from the archive, which a gzip stream cannot seek back for
+    if os.path.lexists(target) and (os.path.islink(target) or not os.path.isdir(target)):
+        os.unlink(target)
+
+def ensure_parent_dirs(members, dataset_path, written=None):
+    """Create each member's parent directory before yielding it"""
+    # Tars extracted side by side share parent directories, and tarfile's own
+    # makedirs() is not safe against another process creating them first
+    made_dirs = set()
+    for member in members:
+        if not os.path.isabs(member.name) and '..' not in member.name.split('/'):
+            parent = os.path.dirname(member.name)
+            if parent and parent not in made_dirs:
+                os.makedirs(os.path.join(dataset_path, parent), exist_ok=True)
+                made_dirs.add(parent)
+            if member.islnk():
+                remove_link_target(os.path.join(dataset_path, member.name))
+            elif member.isreg() and written is not None:
+                written.append(member.name)
+        yield member
+
+def write_member(target, data):
+    """Write one extracted member to disk"""
+    with open(target, 'wb') as f:
+        f.write(data)
+
+def extract_members_threaded(tar, dataset_path, desc, threads=EXTRACT_THREADS):
+    """Extract members, overlapping file writes on a thread pool"""
+    dest = os.path.realpath(dataset_path)
+    made_dirs = set()
+    written = []
+    pending = {}  # future -> (target, size of the data it is writing)
+    writing = set()
+    pending_bytes = 0
+    
+    def drain(jobs=0, size=0):
+        nonlocal pending_bytes
+        while pending and (len(pending) > jobs or pending_bytes > size):
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                target, data_size = pending.pop(future)
+                writing.discard(target)
+                pending_bytes -= data_size
+                future.result()
+    
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        for member in tqdm(tar, desc=desc, unit='file'):
+            # Same checks extract(filter='data') would apply, raising on unsafe members
+            safe = data_filter(member, dest)
+            target = os.path.join(dest, safe.name)
+            parent = os.path.dirname(target)
+            if parent not in made_dirs:
+                os.makedirs(parent, exist_ok=True)
+                made_dirs.add(parent)
+            
+            if target in writing:
+                # A later member with the same name must overwrite the earlier one
+                drain()
+            
+            if safe.isreg():
+                written.append(safe.name)
+            
+            if safe.isreg() and safe.size > STREAM_MEMBER_SIZE:
+                # Too big to hold in memory, so stream it to disk on this thread
+                with tar.extractfile(member) as src, open(target, 'wb') as dst:
+                    shutil.copyfileobj(src, dst, 1 << 20)
+            elif safe.isreg():
+                # Decompression reads one stream, so it stays on this thread
+                data = tar.extractfile(member).read()
+                pending[pool.submit(write_member, target, data)] = (target, len(data))
+                writing.add(target)
+                pending_bytes += len(data)
+                drain(threads * 2, MAX_PENDING_BYTES)
+            else:
+                # Links may refer to files still being written. Directories still
+                # need their mode, otherwise they are left at tarfile's temporary 0700
+                drain()
+                if safe.islnk():
+                    remove_link_target(target)
+                tar.extract(safe, path=dest, set_attrs=member.isdir(), **EXTRACT_OPTIONS)
+        drain()
+    
+    return written
+
+def extract_tar_with_progress(tar_path, extract_to="dataset", progress=True):
+    """Extract a tar file with progress bar, returning the regular file names written"""
+    Path(extract_to).mkdir(exist_ok=True)
+    dataset_path = os.fspath(extract_to)
+    
+    tar_name = os.path.basename(tar_path)
+    tqdm.write(f"Extracting {tar_name}...")
+    
+    with open_tar(tar_path) as tar:
+        if not progress:
+            members = tar
+            if not EXTRACT_OPTIONS:
+                dest = os.path.realpath(dataset_path)
+                members = (data_filter(member, dest) for member in tar)
+            written = []
+            tar.extractall(path=dataset_path,
+                           members=ensure_parent_dirs(members, dataset_path, written),
+                           **EXTRACT_OPTIONS)
+        else:
+            written = extract_members_threaded(tar, dataset_path, tar_name)
+    
+    tqdm.write(f"Extracted {tar_name} to {dataset_path}")
+    return written
+
+def checked_entries(archive, dest_path, written):
+    """Yield libarchive entries, refusing the special files and links filter='data' refuses"""
+    for entry in archive:
+        if entry.isblk or entry.ischr or entry.isfifo:
+            raise tarfile.ExtractError(f"{entry.pathname!r} is a special file")
+        if entry.issym or entry.islnk:
+            check_link(entry.pathname, entry.linkpath, entry.issym, dest_path)
+        elif entry.isreg:
+            written.append(entry.pathname)
+        yield entry
+
+def extract_tar_worker(tar_path, extract_to="dataset"):
+    """Extract one tar inside a worker process of extract_all_tars"""
+    if libarchive is None:
+        return extract_tar_with_progress(tar_path, extract_to, progress=False)
+    
+    tar_name = os.path.basename(tar_path)
+    tqdm.write(f"Extracting {tar_name}...")
+    Path(extract_to).mkdir(exist_ok=True)
+    source = os.path.abspath(tar_path)
+    dest = os.path.realpath(extract_to)
+    cwd = os.getcwd()
+    # libarchive parses headers and writes files in C, but only into the working
+    # directory; a worker process has no other threads that could see the chdir
+    os.chdir(extract_to)
+    written = []
+    try:
+        # PREVENT_ESCAPE refuses absolute paths, '..' and writes through symlinks, but
+        # not links pointing outside, so entries are checked on the way past as well
+        with libarchive.file_reader(source) as archive:
+            extract_entries(checked_entries(archive, dest, written), flags=PREVENT_ESCAPE)
+    finally:
+        os.chdir(cwd)
+    tqdm.write(f"Extracted {tar_name} to {extract_to}")
+    return written
+
+def extract_all_tars(downloads_dir="downloads", extract_to="dataset", tar_files=None,
+                     on_extracted=None, workers=None):
+    """Extract all tar files in downloads directory, several at a time"""
+    if tar_files is None:
+        tar_files = get_tar_files(downloads_dir)
     
     if not tar_files:
         print(f"No tar files found in {downloads_dir}")
@@ -44,14 +280,41 @@ def extract_all_tars(downloads_dir="downloads", extract_to="dataset"):
     
     print(f"Found {len(tar_files)} tar files")
     
+    if workers is None:
+        workers = min(len(tar_files), os.cpu_count() or 1)
+    
     results = {}
-    for tar_file in tar_files:
-        try:
-            extract_tar_with_progress(tar_file, extract_to)
-            results[tar_file.name] = True
-        except Exception as e:
-            print(f"Failed to extract {tar_file.name}: {e}")
-            results[tar_file.name] = False
+    if workers <= 1:
+        for tar_file in tar_files:
+            tar_name = os.path.basename(tar_file)
+            try:
+                written = extract_tar_with_progress(tar_file, extract_to)
+                results[tar_name] = True
+                if on_extracted is not None:
+                    on_extracted(tar_file, written)
+            except Exception as e:
+                print(f"Failed to extract {tar_name}: {e}")
+                results[tar_name] = False
+    else:
+        # Member iteration holds the GIL, so independent tars go to separate processes
+        with ProcessPoolExecutor(max_workers=workers) as executor, \
+                tqdm(total=len(tar_files), desc="Extracting", unit="tar") as pbar:
+            futures = {
+                executor.submit(extract_tar_worker, tar_file, extract_to): tar_file
+                for tar_file in tar_files
+            }
+            for future in as_completed(futures):
+                tar_file = futures[future]
+                tar_name = os.path.basename(tar_file)
+                try:
+                    written = future.result()
+                    results[tar_name] = True
+                    if on_extracted is not None:
+                        on_extracted(tar_file, written)
+                except Exception as e:
+                    tqdm.write(f"Failed to extract {tar_name}: {e}")
+                    results[tar_name] = False
+                pbar.update(1)
     
     # Summary
     successful = sum(1 for success in results.values() if success)
@@ -59,36 +322,50 @@ def extract_all_tars(downloads_dir="downloads", extract_to="dataset"):
     
     return results
 
-def extract_specific_files(filenames, downloads_dir="downloads", extract_to="dataset"):
+def extract_specific_files(filenames, downloads_dir="downloads", extract_to="dataset",
+                           on_extracted=None):
     """Extract specific tar files by name"""
     results = {}
     
     for filename in filenames:
-        tar_path = Path(downloads_dir) / filename
+        tar_path = os.path.join(downloads_dir, filename)
         
-        if not tar_path.exists():
+        if not os.path.exists(tar_path):
             print(f"File not found: {filename}")
             results[filename] = False
             continue
         
         try:
-            extract_tar_with_progress(tar_path, extract_to)
+            written = extract_tar_with_progress(tar_path, extract_to)
             results[filename] = True
+            if on_extracted is not None:
+                on_extracted(tar_path, written)
         except Exception as e:
             print(f"Failed to extract {filename}: {e}")
             results[filename] = False
     
     return results
 
+def list_names(names):
+    """Print the first 10 names and how many more follow"""
+    for name in islice(names, 10):  # Show first 10 files
+        print(f"  {name}")
+    remaining = sum(1 for _ in names)
+    if remaining:
+        print(f"  ... and {remaining} more files")
+
 def list_tar_contents(tar_path):
     """List contents of a tar file without extracting"""
-    with tarfile.open(tar_path, 'r') as tar:
-        members = tar.getmembers()
-        print(f"\nContents of {tar_path.name}:")
-        for member in members[:10]:  # Show first 10 files
-            print(f"  {member.name}")
-        if len(members) > 10:
-            print(f"  ... and {len(members) - 10} more files")
+    print(f"\nContents of {os.path.basename(tar_path)}:")
+    if libarchive is not None:
+        # Reads only the headers, skipping member data without decoding it
+        with libarchive.file_reader(os.fspath(tar_path)) as archive:
+            names = (entry.pathname for entry in archive)
+            list_names(names)
+        return
+    
+    with open_tar(tar_path) as tar:
+        list_names(member.name for member in tar)
 
 if __name__ == "__main__":
     extract_all_tars("downloads", "dataset")